@@ -1,29 +1,158 @@
 # A purpose-built class to parse certain information from .blend files.
 
+import bisect
 import collections
+import collections.abc
+import functools
 import json
 import io
+import mmap
 import re
 import struct
+import sys
+import types
+
+# numpy is optional; only the array accessors need it.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# struct format characters for integers by size in bytes. SDNA integer types
+# are signed; pointers are unsigned addresses.
+_INT_FORMATS = {1: "b", 2: "h", 4: "i", 8: "q"}
+_POINTER_FORMATS = {4: "I", 8: "Q"}
+# struct format characters for floating point SDNA types.
+_FLOAT_FORMATS = {"float": "f", "double": "d"}
+
+# Array dimensions are part of SDNA field names, e.g. "name[64]".
+_ARRAY_LENGTH_RE = re.compile(r"\[([0-9]+)\]")
+
+# SDNA types that are decoded as integers.
+_INT_TYPES = ("short", "int", "long", "long long")
+
+# numpy dtype kinds of SDNA numeric types. The size comes from the SDNA.
+_NUMPY_KINDS = {
+    "char": "u", "uchar": "u", "short": "i", "ushort": "u", "int": "i",
+    "uint": "u", "long": "i", "ulong": "u", "long long": "i",
+    "int8_t": "i", "int64_t": "i", "uint64_t": "u",
+    "float": "f", "double": "f"}
+
+# File blocks whose bodies aren't SDNA structures, even though they carry an
+# SDNA index (of 0): the end marker, the SDNA itself, render info and the
+# thumbnail.
+_NON_STRUCT_CODES = ("ENDB", "DNA1", "REND", "TEST")
+
+# Byte alignment of arrays returned by the array accessors, wide enough for
+# cache line and vector-width reads of the data.
+_ARRAY_ALIGNMENT = 64
+
+# How each structure field is decoded. Decided once per structure type when
+# the SDNA is loaded.
+(_NUMBER, _NUMBER_ARRAY, _CHAR, _CHAR_ARRAY, _STRUCT, _SKIP,
+ _NESTED_ARRAY) = range(7)
 
 class BlendDecodeError(Exception):
     pass
 
+def _aligned_empty(shape, dtype):
+    """
+    Allocate an uninitialized numpy array starting on an _ARRAY_ALIGNMENT
+    byte boundary.
+    """
+    nbytes = dtype.itemsize
+    for dimension in shape:
+        nbytes *= dimension
+    raw = np.empty(nbytes + _ARRAY_ALIGNMENT, np.uint8)
+    start = -raw.ctypes.data % _ARRAY_ALIGNMENT
+    return raw[start:start + nbytes].view(dtype).reshape(shape)
+
+def _nested_array(name):
+    raise ValueError(f"Can't handle nested array {name}.")
+
+class _Reader:
+    """
+    A cursor over a buffer of the mapped file.
+
+    Each reader keeps its own position, so parsing never depends on shared
+    file state and readers over the same buffer don't interfere.
+    """
+
+    def __init__(self, buf, pos=0):
+        """
+        Initialize the reader.
+
+        :param buf: The mmap to read from.
+        :param pos: The byte offset at which to begin reading.
+        """
+        self.buf = buf
+        self.pos = pos
+
+    def read(self, size):
+        """
+        Read size bytes and advance past them.
+        """
+        res = self.buf[self.pos:self.pos + size]
+        self.pos += size
+        return res
+
+    def unpack(self, unpacker):
+        """
+        Unpack a struct.Struct and advance past it.
+        """
+        values = unpacker.unpack_from(self.buf, self.pos)
+        self.pos += unpacker.size
+        return values
+
+    def read_c_strings(self, count, end):
+        """
+        Read consecutive null-terminated C-strings and advance past them.
+
+        All of the strings are split out of the buffer in a single pass.
+
+        :param count: The number of strings to read.
+        :param end: The byte offset the strings must end before.
+        :return A list of the strings.
+        :raises BlendDecodeError
+        """
+        parts = self.buf[self.pos:end].split(b"\0", count)
+        if len(parts) <= count:
+            raise BlendDecodeError(
+                f"Unterminated string after byte offset {self.pos}!")
+        # Whatever follows the last terminator is left in the final part.
+        self.pos = end - len(parts.pop())
+        # SDNA names and types are plain ASCII. They are interned, as they
+        # are used over and over as dict keys.
+        return [sys.intern(part.decode("ascii")) for part in parts]
+
+    def align(self):
+        """
+        Advance to the next multiple of 4 bytes.
+        """
+        self.pos = (self.pos + 3) & ~3
+
 class BlendStruct(collections.abc.Mapping):
     """
     Read-only dict-like datatype representing a structure in a .blend file.
     """
 
+    __slots__ = ("_load_cb", "_type", "_field_index", "_values")
+
     def __init__(self, load_cb, type):
         """
         Initialize the BlendStruct.
 
-        :param load_cb: A callback to load the structure.
+        :param load_cb: A callback to load the structure. It returns either a
+        dict of the structure's fields, or a dict mapping field names to
+        indices, shared by every structure of the type, and a list of the
+        field values.
         :param type: The type of the structure.
         """
         self._load_cb = load_cb
         self._type = type
-        self._structure = None
+        # Set when the structure is loaded.
+        self._field_index = None
+        self._values = None
 
     def load(self):
         """
@@ -31,47 +160,53 @@ class BlendStruct(collections.abc.Mapping):
 
         :return The loaded blend struct (self)
         """
-        if self._structure is None:
-            self._structure = self._load_cb()
+        if self._values is not None:
+            return self
+        structure = self._load_cb()
+        if type(structure) is tuple:
+            self._field_index, self._values = structure
+        else:
+            # A plain mapping of the structure's fields.
+            self._field_index = {
+                field: i for i, field in enumerate(structure)}
+            self._values = list(structure.values())
+        self._load_cb = None
         return self
 
     def __str__(self):
-        if self._structure is None:
+        if self._values is None:
             return f"<Blender Structure {self._type} (unloaded)>"
-        else:
-            return str(self._structure)
+        return str(dict(zip(self._field_index, self._values)))
 
     def __repr__(self):
-        if self._structure is None:
+        if self._values is None:
             return f"<Blender Structure {self._type} (unloaded)>"
-        else:
-            return f"<Blender Structure {self._type} (loaded)>"
+        return f"<Blender Structure {self._type} (loaded)>"
 
     def __getitem__(self, item):
-        if self._structure is None:
-            self._structure = self._load_cb()
-        return self._structure[item]
+        if self._values is None:
+            self.load()
+        return self._values[self._field_index[item]]
 
     def __iter__(self):
-        if self._structure is None:
-            self._structure = self._load_cb()
-        return self._structure.__iter__()
+        if self._values is None:
+            self.load()
+        return self._field_index.__iter__()
 
     def __len__(self):
-        if self._structure is None:
-            self._structure = self._load_cb()
-        return len(self._structure)
+        if self._values is None:
+            self.load()
+        return len(self._values)
 
     def inspect(self):
         """
         Return a human readable representation of the struct.
         """
-        summary = {}
-        if self._structure is None:
-            self._structure = self._load_cb()
-        for field, value in self._structure.items():
-            summary[field] = repr(value)
-        return json.dumps(summary, indent=4)
+        loaded = self.load()
+        return json.dumps(
+            {field: repr(value) for field, value in
+             zip(loaded._field_index, loaded._values)},
+            indent=4)
 
 # A class for opening and reading data from .blend files
 class Blendfile(io.FileIO):
@@ -99,249 +234,406 @@ class Blendfile(io.FileIO):
     _BlockHeader = collections.namedtuple(
         "BlockHeader", ("blockcode", "size", "address", "sdna_index", "count"))
 
+    # How to decode a structure type, built by _compile_struct.
+    # fields: (name, kind, size, length, arg) for each field.
+    # layout: struct.Struct for all numeric and char fields of the structure.
+    # field_index: Maps each field name to the position of its value.
+    # read_fields: Generated function taking the unpacked layout and the
+    # structure's byte offset, and returning the list of field values.
+    _CompiledStruct = collections.namedtuple(
+        "CompiledStruct", ("fields", "layout", "field_index", "read_fields"))
+
     def __init__(self, filename):
         super().__init__(filename, "rb")
+        # The whole file is mapped into memory once. Parsing reads slices of
+        # the mapping at explicit offsets instead of seeking the file.
+        try:
+            self._mm = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped.
+            super().close()
+            raise BlendDecodeError("File is empty!") from None
+        self._buf = memoryview(self._mm)
         # Offset of first file block header.
         self._block_start = 12
-        self._load_header()
-
-        # Endianess symbol for struct format string.
-        if self.endianness == "big":
-            endianness_format = ">"
-        else:
-            endianness_format = "<"
-        self._block_header_struct = struct.Struct(
-            f"{endianness_format}4si{self.pointer_size}sii")
-
-        # Offsets of each file block by code.
-        self._block_offsets = self._read_block_headers()
-        # SDNA structures by name.
-        self._sdna = self._load_sdna()
+        try:
+            self._load_header()
+        except BaseException:
+            # Not a .blend file; don't leave it open.
+            self.close()
+            raise
+
+        # Offsets of each file block by code, filled in as the file is
+        # scanned, and where the next scan continues from.
+        self._block_offsets = {}
+        self._scan_offset = self._block_start
+        # Every file block, in file order. Codes such as DATA are shared by
+        # many blocks, of which _block_offsets only keeps the last.
+        self._blocks = []
+        # Block codes in sorted order, so get_blocks() can find the range
+        # matching a prefix by bisection and only visit those blocks.
+        self._sorted_codes = []
+        # Functions to load each file block, created on first request.
+        self._block_loaders = {}
+        # How to decode each structure type, by name. Filled in as types are
+        # first loaded.
+        self._compiled_structs = {}
+        # SDNA structures by name. Loaded on first use through _sdna, so
+        # callers that only list blocks never parse it.
+        self._loaded_sdna = None
+        # Loaded structures by (struct name, byte offset), shared between all
+        # BlendStructs that refer to the same bytes.
+        self._struct_cache = {}
 
     def __str__(self):
         return f"Blender file version {self.version}"
 
-    def _read_c_string(self):
-        """
-        Utility method to read a null-terminated C-string.
-        """
-        res = bytes("", "utf-8")
-        null_char = bytes("\0", "utf-8")
-        while True:
-            char = self.read(1)
-            if char == null_char:
-                return res.decode("utf-8")
-            res += char
-
-    def _construct_value(self, type, is_ptr, length):
-        """
-        Construct a value from a type.
-        
-        This is gonna be messy; documentation can come later.
-        """
-        if length > 1:
-            arr = []
-            # Skip for now.
-            size = self._sdna["tlen"][type]
-            for _ in range(length):
-                self.seek(size, io.SEEK_CUR)
-                #arr.append(self._construct_value(type, False, 1))
-            return arr
-
-        INT_TYPES = ("short", "int", "long", "long long")
-        if type in self._sdna["structs"]:
-            offset = self.tell()
-            self.seek(self._sdna["tlen"][type], io.SEEK_CUR)
-            return BlendStruct(self._struct_loader(type, offset), type)
-        elif type in INT_TYPES:
-            size = self._sdna["tlen"][type]
-            return int.from_bytes(self.read(size), self.endianness)
-        elif type == "char":
-            if is_ptr:
-                return self._read_c_string()
-            else:
-                return self.read(1)
-        else:
-            size = self._sdna["tlen"][type]
-            self.seek(size, io.SEEK_CUR)
-            return type
+    @property
+    def _sdna(self):
+        if self._loaded_sdna is None:
+            self._loaded_sdna = self._load_sdna()
+        return self._loaded_sdna
+
+    def close(self):
+        # The memoryview has to be released before the mapping can be closed.
+        if getattr(self, "_mm", None) is not None:
+            self._buf.release()
+            try:
+                self._mm.close()
+            except BufferError:
+                # Views from block_memoryview() or block_ndarray() are still
+                # alive. They keep the mapping open until they are gone.
+                pass
+            self._mm = None
+        super().close()
 
     def _load_header(self):
         """
         Unpack the file header.
 
         Verifies the file identifier, and sets the pointer size, endianess, and
-        blender version.
+        blender version. Pointer size and endianness are fixed for the file,
+        so every struct the parser reads with is compiled once, here.
 
         :raises BlendDecodeError
         """
-        self.seek(0)
-        header_size = self._blend_header_struct.size
+        if len(self._mm) < self._blend_header_struct.size:
+            raise BlendDecodeError("File is too short for a header!")
         # Does not decode bytes. Decoding bytes could raise an exception, so
         # by validating the fields ourselves by comparing bytes, we can raise
         # an exception with more useful information.
         header = self._BlendHeader(
-            *self._blend_header_struct.unpack_from(self.read(header_size)))
+            *_Reader(self._mm).unpack(self._blend_header_struct))
 
-        if header.identifier != bytes("BLENDER", "utf-8"):
+        if header.identifier != b"BLENDER":
             raise BlendDecodeError("File identifier is not 'BLENDER'!")
-        if header.pointer_size == bytes("-", "utf-8"):
+        if header.pointer_size == b"-":
             self.pointer_size = 8
-        elif header.pointer_size == bytes("_", "utf-8"):
+        elif header.pointer_size == b"_":
             self.pointer_size = 4
         else:
             raise BlendDecodeError(
                 f"Invalid pointer size character {header.pointer_size}; " \
                 f"must be {b'-'} or {b'_'}!")
-        if header.endianness == bytes("v", "utf-8"):
+        # Endianess symbol for struct format strings.
+        if header.endianness == b"v":
             self.endianness = "little"
-        elif header.endianess == bytes("V", "utf-8"):
+            self._byte_order = "<"
+        elif header.endianness == b"V":
             self.endianness = "big"
+            self._byte_order = ">"
         else:
             raise BlendDecodeError(
-                f"Invalid endianness character {header.endianess}; "\
+                f"Invalid endianness character {header.endianness}; "\
                 f"must be {b'v'} or {b'V'}")
         if not header.version.isdigit():
             raise BlendDecodeError(
                 f"Invalid version string {header.version}!")
-        self.version = "v{}.{}{}".format(*header.version.decode("utf-8"))
-
-    def _read_block_headers(self):
+        self.version = "v{}.{}{}".format(*header.version.decode("ascii"))
+
+        self._structs = types.SimpleNamespace(
+            block_header=struct.Struct(
+                f"{self._byte_order}4si{self.pointer_size}sii"),
+            # Pairs of unsigned shorts in the SDNA block (struct type and
+            # field count, field type and field name).
+            u16_pair=struct.Struct(f"{self._byte_order}HH"),
+            # SDNA section header: a 4 byte identifier and a count.
+            sdna_section=struct.Struct(f"{self._byte_order}4sI"))
+
+    def _scan_blocks(self):
         """
-        Read the header of each file block and store the offset of its body.
+        Read the headers of file blocks that haven't been read yet.
 
-        :return A dict of file block codes mapped to tuples of the format
-        (_BlockHeader, byte_offset).
-        """
+        Each scan continues where the last one stopped, so the file is only
+        walked as far as needed. Blocks are stored in self._block_offsets,
+        mapping file block codes to plain tuples of the format
+        (blockcode, size, address, sdna_index, count, byte_offset), and in
+        file order in self._blocks. The first five fields make up a
+        _BlockHeader, which is only built when a block is actually loaded.
 
-        block_offsets = {}
-        self.seek(self._block_start)
-        while True:
-            # If no bytes are read we are at EOF.
-            header_bytes = self.read(self._block_header_struct.size)
-            if len(header_bytes) == 0:
-                break
-
-            # Header will be read and then recreated with decoded values.
-            header = self._BlockHeader(
-                *self._block_header_struct.unpack_from(header_bytes))
+        :return Generator that yields the code of each block as it is read.
+        """
+        if self.closed:
+            raise ValueError("I/O operation on a closed file.")
+        header_struct = self._structs.block_header
+        file_size = len(self._mm)
+        # Stop once there are no bytes left.
+        while self._scan_offset < file_size:
+            pos = self._scan_offset
+            blockcode, size, address, sdna_index, count = \
+                header_struct.unpack_from(self._buf, pos)
             try:
-                blockcode = header.blockcode.decode("utf-8")
+                # Codes such as DATA repeat throughout the file; interning
+                # shares one string between them.
+                blockcode = sys.intern(blockcode.decode("ascii"))
             except UnicodeDecodeError as e:
                 # Workaround to avoid having "During handling of..." error.
                 raise BlendDecodeError(
-                    f"Can't decode block code {header.blockcode}!") from None
-            header_decoded = self._BlockHeader(
-                blockcode, header.size, header.address,
-                header.sdna_index, header.count)
+                    f"Can't decode block code {blockcode}!") from None
 
             # Beginning of file block body.
-            offset = self.tell()
-            block_offsets[blockcode] = (header_decoded, offset)
-            self.seek(header_decoded.size, io.SEEK_CUR)
+            pos += header_struct.size
+            if blockcode not in self._block_offsets:
+                bisect.insort(self._sorted_codes, blockcode)
+            block = (blockcode, size, address, sdna_index, count, pos)
+            self._block_offsets[blockcode] = block
+            self._blocks.append(block)
+            # The next header directly follows the body. ENDB marks the end
+            # of the file blocks; anything after it is not a block.
+            if blockcode == "ENDB":
+                self._scan_offset = file_size
+            else:
+                self._scan_offset = pos + size
+            yield blockcode
 
-        return block_offsets
+    def _scan_all_blocks(self):
+        """
+        Read the headers of all remaining file blocks.
+        """
+        for _ in self._scan_blocks():
+            pass
 
     def _load_sdna(self):
         """
         Load each SDNA structure.
         """
+        # There is only one DNA1 block, so there is no need to scan past it.
+        if "DNA1" not in self._block_offsets:
+            for blockcode in self._scan_blocks():
+                if blockcode == "DNA1":
+                    break
         try:
-            offset = self._block_offsets["DNA1"][1]
+            _, size, _, _, _, offset = self._block_offsets["DNA1"]
         except KeyError:
             raise ValueError("Missing DNA1 file block.") from None
+        end = offset + size
 
         sdna = {}
         # Skip file block header.
-        self.seek(offset)
+        reader = _Reader(self._mm, offset)
+        sdna_section = self._structs.sdna_section
+        u16_pair = self._structs.u16_pair
 
         # Identifier; should be "SDNA"
-        self.seek(4, io.SEEK_CUR)
-        # Name; should be "NAME"
-        self.seek(4, io.SEEK_CUR)
+        reader.pos += 4
+        # Name identifier; should be "NAME". The number of names follows.
+        name_identifier, total_names = reader.unpack(sdna_section)
+        assert(name_identifier == b"NAME")
 
         # List of structure names.
-        total_names = int.from_bytes(self.read(4), self.endianness)
-        names = []
-        for _ in range(total_names):
-            names.append(self._read_c_string())
+        names = reader.read_c_strings(total_names, end)
         sdna["names"] = names
+        # Array dimensions of each name. Names are shared between structures,
+        # so each one is only parsed once.
+        sdna["dimensions"] = {
+            name: tuple(int(d) for d in _ARRAY_LENGTH_RE.findall(name))
+            for name in names}
 
         # List of types
         # Align at 4 bytes.
-        if self.tell() % 4 != 0:
-            self.seek(4 - (self.tell() % 4), io.SEEK_CUR)
-        # Type identifier; should be "TYPE"
-        type_identifier = self.read(4).decode("utf-8")
-        assert(type_identifier == "TYPE")
-        # Number of types follows.
-        total_types = int.from_bytes(self.read(4), self.endianness)
+        reader.align()
+        # Type identifier; should be "TYPE". The number of types follows.
+        type_identifier, total_types = reader.unpack(sdna_section)
+        assert(type_identifier == b"TYPE")
         # Avoiding collision with builtin types module.
-        _types = []
-        for _ in range(total_types):
-            _types.append(self._read_c_string())
+        _types = reader.read_c_strings(total_types, end)
         sdna["types"] = _types
 
         # Length of each type.
         # Align at 4 bytes.
-        if self.tell() % 4 != 0:
-            self.seek(4 - (self.tell() % 4), io.SEEK_CUR)
+        reader.align()
         # Type length identifier; should be "TLEN"
-        len_identifier = self.read(4).decode("utf-8")
-        assert(len_identifier == "TLEN")
-        type_lengths = {}
-        for i in range(total_types):
-            length = int.from_bytes(self.read(2), self.endianness)
-            type_lengths[_types[i]] = length
-        sdna["tlen"] = type_lengths
+        len_identifier = reader.read(4)
+        assert(len_identifier == b"TLEN")
+        # One u16 per type, decoded together.
+        type_lengths = struct.Struct(f"{self._byte_order}{total_types}H")
+        sdna["tlen"] = dict(zip(_types, reader.unpack(type_lengths)))
 
         # Align at 4 bytes.
-        if self.tell() % 4 != 0:
-            self.seek(4 - (self.tell() % 4), io.SEEK_CUR)
-        # Structure identifier; should be "STRC".
-        struct_identifier = self.read(4).decode("utf-8")
-        assert(struct_identifier == "STRC")
+        reader.align()
+        # Structure identifier; should be "STRC". The number of structures
+        # follows.
+        struct_identifier, total_structs = reader.unpack(sdna_section)
+        assert(struct_identifier == b"STRC")
         structs = {}
-        # Number of structures follows.
-        total_structs = int.from_bytes(self.read(4), self.endianness)
         for _ in range(total_structs):
-            # Index in types containing the name of the structure.
-            type_index = int.from_bytes(self.read(2), self.endianness)
+            # Index in types containing the name of the structure, followed by
+            # the number of fields in this structure.
+            type_index, total_fields = reader.unpack(u16_pair)
             fields = {}
-            # Number of fields in this structure.
-            total_fields = int.from_bytes(self.read(2), self.endianness)
-            for _ in range(total_fields):
-                # Index in type
-                field_type = int.from_bytes(self.read(2), self.endianness)
-                # Index in name
-                field_name = int.from_bytes(self.read(2), self.endianness)
+            # Each field is an index in type, then an index in name. The
+            # whole field table is decoded by one unpack and split into the
+            # two interleaved index lists.
+            field_table = struct.unpack_from(
+                f"{self._byte_order}{2 * total_fields}H", reader.buf,
+                reader.pos)
+            reader.pos += total_fields * u16_pair.size
+            for field_type, field_name in zip(
+                    field_table[0::2], field_table[1::2]):
                 fields[names[field_name]] = _types[field_type]
             structs[_types[type_index]] = fields
         sdna["structs"] = structs
+        # File block headers refer to structures by index.
+        sdna["struct_names"] = tuple(structs)
 
         return sdna
 
+    def _compile_struct(self, struct_name):
+        """
+        Work out how to decode each field of a structure type.
+
+        The layout of a structure is the same for every instance, so this is
+        done once per type, the first time the type is needed. Fields are
+        described by (name, kind, size, length, arg) tuples, where size is
+        the size of the whole field in bytes and arg depends on the kind. All
+        numeric and char fields of the structure are also compiled into a
+        single struct, with padding over the other fields, so one unpack_from
+        call decodes them for an instance.
+
+        The fields are then turned into the source of a function that builds
+        the list of field values with one expression per field, at constant
+        value indices and byte offsets, so loading a structure doesn't need
+        to dispatch on each field's kind.
+
+        :param struct_name: The name of the structure type.
+        :return A _CompiledStruct.
+        """
+        compiled = self._compiled_structs.get(struct_name)
+        if compiled is not None:
+            return compiled
+
+        sdna = self._sdna
+        field_ops = []
+        layout = [self._byte_order]
+        total_values = 0
+        for name, type in sdna["structs"][struct_name].items():
+            dimensions = sdna["dimensions"][name]
+            length = 1
+            for dimension in dimensions:
+                length *= dimension
+            # Pointers (including function pointers) hold an address, so they
+            # are pointer_size wide whatever they point to.
+            is_ptr = name.startswith(("*", "(*"))
+            if is_ptr:
+                size = self.pointer_size
+            else:
+                size = sdna["tlen"][type]
+
+            arg = type
+            format_chars = None
+            if len(dimensions) > 1:
+                kind = _NESTED_ARRAY
+            elif is_ptr or type in _INT_TYPES:
+                if is_ptr:
+                    format_chars = f"{length}{_POINTER_FORMATS[size]}"
+                else:
+                    format_chars = f"{length}{_INT_FORMATS[size]}"
+                kind = _NUMBER_ARRAY if length > 1 else _NUMBER
+            elif type in _FLOAT_FORMATS:
+                format_chars = f"{length}{_FLOAT_FORMATS[type]}"
+                kind = _NUMBER_ARRAY if length > 1 else _NUMBER
+            elif type == "char" and length > 1:
+                kind = _CHAR_ARRAY
+            elif length > 1:
+                # Other arrays are skipped for now.
+                kind = _SKIP
+            elif type in sdna["structs"]:
+                kind = _STRUCT
+            elif type == "char":
+                format_chars = "c"
+                kind = _CHAR
+            else:
+                kind = _SKIP
+
+            if format_chars is None:
+                layout.append(f"{size * length}x")
+            else:
+                # arg is the index of the field's first value in the unpacked
+                # layout.
+                layout.append(format_chars)
+                arg = total_values
+                total_values += length
+            field_ops.append((name, kind, size * length, length, arg))
+
+        # Only repr()s of names from the file end up in the source.
+        expressions = []
+        offset = 0
+        for name, kind, size, length, arg in field_ops:
+            if kind == _NUMBER or kind == _CHAR:
+                expressions.append(f"values[{arg}]")
+            elif kind == _NUMBER_ARRAY:
+                expressions.append(f"list(values[{arg}:{arg + length}])")
+            elif kind == _CHAR_ARRAY:
+                expressions.append(
+                    f"read_char_array(pos + {offset}, {size})")
+            elif kind == _STRUCT:
+                expressions.append(
+                    f"BlendStruct(struct_loader({arg!r}, pos + {offset}), "
+                    f"{arg!r})")
+            elif kind == _SKIP:
+                expressions.append("[]" if length > 1 else repr(arg))
+            else:
+                expressions.append(f"nested_array({name!r})")
+            offset += size
+        source = "def read_fields(values, pos):\n    return [\n"
+        source += "".join(f"        {e},\n" for e in expressions)
+        source += "    ]\n"
+        namespace = {
+            "BlendStruct": BlendStruct,
+            "struct_loader": self._struct_loader,
+            "read_char_array": self._read_char_array,
+            "nested_array": _nested_array,
+        }
+        exec(source, namespace)
+
+        compiled = self._CompiledStruct(
+            tuple(field_ops), struct.Struct("".join(layout)),
+            {op[0]: i for i, op in enumerate(field_ops)},
+            namespace["read_fields"])
+        self._compiled_structs[struct_name] = compiled
+        return compiled
+
+    def _read_char_array(self, offset, size):
+        """
+        Read a fixed size string field.
+
+        Fixed size strings are null-terminated within the field. They hold
+        user data, such as names, which may be UTF-8.
+        """
+        field = self._buf[offset:offset + size].tobytes()
+        return field.split(b"\0", 1)[0].decode("utf-8", "replace")
+
     def _load_struct(self, struct_name, offset):
         """
         Load a struct according to the SDNA.
 
         :param struct_name: The name of the structure type.
         :param offset: The byte offset at which to begin loading.
-        :return The loaded structure.
+        :return A list of the structure's field values, in field order.
         """
-        structure = {}
-        fields = self._sdna["structs"][struct_name]
-        for name, type in fields.items():
-            lengths = re.findall(r"\[([0-9]+)\]", name)
-            if len(lengths) > 1:
-                raise ValueError(f"Can't handle nested array {name}.")
-            elif len(lengths) == 1:
-                length = int(lengths[0])
-            else:
-                length = 1
-            is_ptr = name.startswith("*")
-            structure[name] = self._construct_value(type, is_ptr, length)
-        return structure
+        compiled = self._compile_struct(struct_name)
+        return compiled.read_fields(
+            compiled.layout.unpack_from(self._buf, offset), offset)
 
     def get_blocks(self, match=""):
         """
@@ -352,24 +644,254 @@ class Blendfile(io.FileIO):
         :param match: Filter file blocks by matching the beginning of the name
         against a string. Default is "" (matches everything). Case sensitive.
         :return A dictionary mapping identifiers to a function to load the
-        block.
+        block, in order of identifier.
         """
-        # Invoking the load_block() closure will load the file block at offset.
-        def create_loader(header, at_offset):
-            def load_block():
-                return self._load_block(header, at_offset)
-            return load_block
-
+        self._scan_all_blocks()
+        # Codes are ASCII, so every code starting with match sorts before
+        # match + "\xff".
+        start = bisect.bisect_left(self._sorted_codes, match)
+        end = bisect.bisect_left(self._sorted_codes, match + "\xff")
         matched_blocks = {}
-        for identifier, header in self._block_offsets.items():
-            if identifier.startswith(match):
-                matched_blocks[identifier] = create_loader(*header)
+        for identifier in self._sorted_codes[start:end]:
+            loader = self._block_loaders.get(identifier)
+            if loader is None:
+                # Invoking the loader will load the file block at offset.
+                *header, offset = self._block_offsets[identifier]
+                loader = functools.partial(
+                    self._load_block, self._BlockHeader(*header), offset)
+                self._block_loaders[identifier] = loader
+            matched_blocks[identifier] = loader
         return matched_blocks
 
-    # Helper for creating a callback to load a given structure.
+    def _find_block(self, code):
+        """
+        Look up a file block by code, scanning the rest of the file first.
+
+        :return The (blockcode, size, address, sdna_index, count, byte_offset)
+        tuple of the block.
+        :raises ValueError if there is no such block.
+        """
+        self._scan_all_blocks()
+        try:
+            return self._block_offsets[code]
+        except KeyError:
+            raise ValueError(f"Missing {code} file block.") from None
+
+    def block_memoryview(self, code):
+        """
+        Get the body of a file block without copying it.
+
+        The view aliases the mapped file. It stays valid after the Blendfile
+        is closed, keeping the mapping open until the view is released.
+
+        :param code: The file block code, as returned by get_blocks().
+        :return A read-only memoryview of the file block body.
+        :raises ValueError if the block is missing.
+        """
+        _, size, _, _, _, offset = self._find_block(code)
+        return self._buf[offset:offset + size]
+
+    def block_ndarray(self, code, dtype):
+        """
+        Get the body of a file block as a numpy array without copying it.
+
+        Requires numpy. The array aliases the mapped file in the same way as
+        block_memoryview(), and is read-only. The file's byte order is
+        applied to dtype.
+
+        :param code: The file block code, as returned by get_blocks().
+        :param dtype: The numpy dtype of each element.
+        :return A one-dimensional numpy.ndarray over as many whole elements
+        as fit in the block body.
+        :raises ValueError if the block is missing.
+        """
+        if np is None:
+            raise ImportError("block_ndarray() requires numpy.")
+        _, size, _, _, _, offset = self._find_block(code)
+        dtype = np.dtype(dtype).newbyteorder(self._byte_order)
+        return np.frombuffer(
+            self._mm, dtype, count=size // dtype.itemsize, offset=offset)
+
+    def get_block_array(self, code, field):
+        """
+        Read one field of every structure in a file block into an array.
+
+        Requires numpy. Rather than loading each structure, the field is read
+        through a single strided view of the file block body, which is then
+        copied out in native byte order. The array starts on a 64 byte
+        boundary.
+
+        :param code: The file block code, as returned by get_blocks().
+        :param field: The field name as it appears in the SDNA, e.g. "co[3]".
+        :return A numpy.ndarray with one row per structure in the block, and
+        one further dimension per array dimension of the field.
+        :raises ValueError if the block or field is missing, or the field is
+        not numeric.
+        """
+        if np is None:
+            raise ImportError("get_block_array() requires numpy.")
+        view = self._field_view(self._find_block(code), field)
+        array = _aligned_empty(view.shape, view.dtype.newbyteorder("="))
+        np.copyto(array, view)
+        return array
+
+    def get_array(self, struct_name, field):
+        """
+        Read one field of every structure of a type into an array.
+
+        Requires numpy. Like get_block_array(), but gathers the field from
+        all file blocks of the given structure type, in file order. The array
+        starts on a 64 byte boundary.
+
+        :param struct_name: The SDNA structure type, e.g. "MVert".
+        :param field: The field name as it appears in the SDNA, e.g. "co[3]".
+        :return A numpy.ndarray with one row per structure, and one further
+        dimension per array dimension of the field.
+        :raises ValueError if the structure type or field is missing, or the
+        field is not numeric.
+        """
+        if np is None:
+            raise ImportError("get_array() requires numpy.")
+        struct_names = self._sdna["struct_names"]
+        try:
+            sdna_index = struct_names.index(struct_name)
+        except ValueError:
+            raise ValueError(f"Missing {struct_name} structure.") from None
+        self._scan_all_blocks()
+        # Raw data blocks also have an SDNA index of 0, so empty blocks and
+        # blocks too small to hold their structures are left out.
+        size = self._sdna["tlen"][struct_name]
+        blocks = [
+            block for block in self._blocks
+            if block[3] == sdna_index and block[4] > 0
+            and block[1] >= block[4] * size
+            and block[0] not in _NON_STRUCT_CODES]
+        if not blocks:
+            raise ValueError(f"No file blocks of {struct_name} structures.")
+        views = [self._field_view(block, field) for block in blocks]
+        array = _aligned_empty(
+            (sum(len(view) for view in views), *views[0].shape[1:]),
+            views[0].dtype.newbyteorder("="))
+        np.concatenate(views, out=array)
+        return array
+
+    def get_block_records(self, code):
+        """
+        Get the structures of a file block as a numpy structured array.
+
+        Requires numpy. Instead of one BlendStruct per structure, the whole
+        block body is viewed as records without copying, which suits blocks
+        with many structures, such as mesh vertices. The array aliases the
+        mapped file like block_ndarray(), and is read-only. Fields are named
+        as they appear in the SDNA. Pointers are unsigned addresses, char
+        arrays are bytes strings, and nested structures are nested records.
+
+        :param code: The file block code, as returned by get_blocks().
+        :return A one-dimensional numpy.ndarray with one record per structure
+        in the block.
+        :raises ValueError if the block is missing, or its structure has a
+        field that isn't numeric, char, pointer or structure data.
+        """
+        if np is None:
+            raise ImportError("get_block_records() requires numpy.")
+        _, _, _, sdna_index, count, offset = self._find_block(code)
+        dtype = self._record_dtype(self._sdna["struct_names"][sdna_index])
+        return np.frombuffer(self._mm, dtype, count=count, offset=offset)
+
+    def _record_dtype(self, struct_name):
+        """
+        Build the numpy dtype of one structure, in the file's byte order.
+
+        :raises ValueError if a field can't be represented.
+        """
+        fields = self._sdna["structs"][struct_name]
+        names, formats, offsets = [], [], []
+        field_offset = 0
+        for name, _, size, _, _ in self._compile_struct(struct_name).fields:
+            dimensions = self._sdna["dimensions"][name]
+            type = fields[name]
+            if name.startswith(("*", "(*")):
+                base = np.dtype(f"{self._byte_order}u{self.pointer_size}")
+            elif type == "char" and dimensions:
+                # Fixed size strings; numpy drops the trailing nulls.
+                base = np.dtype(f"S{dimensions[-1]}")
+                dimensions = dimensions[:-1]
+            elif type == "char":
+                base = np.dtype("S1")
+            elif type in self._sdna["structs"]:
+                base = self._record_dtype(type)
+            elif type in _NUMPY_KINDS:
+                base = np.dtype(
+                    f"{self._byte_order}{_NUMPY_KINDS[type]}"
+                    f"{self._sdna['tlen'][type]}")
+            else:
+                raise ValueError(
+                    f"Can't make a record of {type} field {name} in "
+                    f"{struct_name}.")
+            names.append(name)
+            formats.append((base, dimensions) if dimensions else base)
+            offsets.append(field_offset)
+            field_offset += size
+        return np.dtype({
+            "names": names, "formats": formats, "offsets": offsets,
+            "itemsize": self._sdna["tlen"][struct_name]})
+
+    def _field_view(self, block, field):
+        """
+        Get a strided numpy view of one field of every structure in a block.
+
+        :param block: The (blockcode, size, address, sdna_index, count,
+        byte_offset) tuple of the block.
+        :param field: The field name as it appears in the SDNA.
+        :return A numpy.ndarray aliasing the mapped file, in file byte order.
+        """
+        _, _, _, sdna_index, count, offset = block
+        struct_name = self._sdna["struct_names"][sdna_index]
+
+        # Fields are laid out one after the other.
+        field_offset = 0
+        for name, _, size, _, _ in self._compile_struct(struct_name).fields:
+            if name == field:
+                break
+            field_offset += size
+        else:
+            raise ValueError(f"Structure {struct_name} has no field {field}.")
+
+        if field.startswith(("*", "(*")):
+            dtype = f"u{self.pointer_size}"
+        else:
+            type = self._sdna["structs"][struct_name][field]
+            if type not in _NUMPY_KINDS:
+                raise ValueError(
+                    f"Can't make an array of {type} field {field}.")
+            dtype = f"{_NUMPY_KINDS[type]}{self._sdna['tlen'][type]}"
+        dtype = np.dtype(self._byte_order + dtype)
+
+        # Structures are tlen bytes apart; the elements of an array field are
+        # packed within each one.
+        dimensions = self._sdna["dimensions"][field]
+        strides = []
+        stride = dtype.itemsize
+        for dimension in reversed(dimensions):
+            strides.insert(0, stride)
+            stride *= dimension
+        return np.ndarray(
+            (count, *dimensions), dtype, buffer=self._mm,
+            offset=offset + field_offset,
+            strides=(self._sdna["tlen"][struct_name], *strides))
+
+    # Helper for creating a callback to load a given structure. Parsing is
+    # deterministic, so each structure is only ever loaded once.
     def _struct_loader(self, name, at_offset):
         def load_struct():
-            return self._load_struct(name, at_offset)
+            if self.closed:
+                raise ValueError("I/O operation on a closed file.")
+            key = (name, at_offset)
+            structure = self._struct_cache.get(key)
+            if structure is None:
+                structure = self._load_struct(name, at_offset)
+                self._struct_cache[key] = structure
+            return self._compile_struct(name).field_index, structure
         return load_struct
 
     def _load_block(self, header, offset):
@@ -386,8 +908,10 @@ class Blendfile(io.FileIO):
             raise ValueError("I/O operation on a closed file.")
 
         # The type of the structure.
-        name = list(self._sdna["structs"])[header.sdna_index]
-        for _ in range(header.count):
-            yield BlendStruct(self._struct_loader(name, self.tell()), name)
+        name = self._sdna["struct_names"][header.sdna_index]
+        size = self._sdna["tlen"][name]
+        for i in range(header.count):
+            yield BlendStruct(
+                self._struct_loader(name, offset + i * size), name)
 
-__all__ = ("BlendStruct", "Blendfile")
\ No newline at end of file
+__all__ = ("BlendDecodeError", "BlendStruct", "Blendfile")
\ No newline at end of file
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import functools
+import gc
+import os
+import struct
+import tempfile
+import unittest
+import warnings
+
+import blendparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# A minimal SDNA:
+# ID { void *next; char name[8]; int us; },
+# MVert { float co[3]; short no[3]; char flag; char bweight; } and
+# Object { ID id; double mass; }.
+_NAMES = (
+    b"*next", b"name[8]", b"us", b"co[3]", b"no[3]", b"flag", b"bweight",
+    b"id", b"mass")
+_TYPES = (
+    b"char", b"short", b"int", b"float", b"double", b"void", b"ID",
+    b"MVert", b"Object")
+_STRUCTS = (
+    (6, ((5, 0), (0, 1), (2, 2))),
+    (7, ((3, 3), (1, 4), (0, 5), (0, 6))),
+    (8, ((6, 7), (4, 8))))
+
+def _align(data):
+    return data + b"\0" * (-len(data) % 4)
+
+def _sdna(byte_order, pointer_size):
+    id_size = pointer_size + 12
+    tlen = (1, 2, 4, 4, 8, 0, id_size, 20, id_size + 8)
+    data = b"SDNA" + b"NAME" + struct.pack(f"{byte_order}I", len(_NAMES))
+    data = _align(data + b"".join(name + b"\0" for name in _NAMES))
+    data += b"TYPE" + struct.pack(f"{byte_order}I", len(_TYPES))
+    data = _align(data + b"".join(type + b"\0" for type in _TYPES))
+    data = _align(
+        data + b"TLEN" + struct.pack(f"{byte_order}{len(tlen)}H", *tlen))
+    data += b"STRC" + struct.pack(f"{byte_order}I", len(_STRUCTS))
+    for type, fields in _STRUCTS:
+        data += struct.pack(f"{byte_order}HH", type, len(fields))
+        for field in fields:
+            data += struct.pack(f"{byte_order}HH", *field)
+    return data
+
+def _pointer(byte_order, pointer_size, address):
+    return struct.pack(
+        byte_order + {4: "I", 8: "Q"}[pointer_size], address)
+
+def _block(byte_order, pointer_size, code, sdna_index, count, body):
+    return (
+        struct.pack(f"{byte_order}4si", code, len(body))
+        + _pointer(byte_order, pointer_size, 0x1000)
+        + struct.pack(f"{byte_order}ii", sdna_index, count) + body)
+
+def _id(byte_order, pointer_size, next, name, us):
+    return (
+        _pointer(byte_order, pointer_size, next)
+        + struct.pack(f"{byte_order}8si", name, us))
+
+def _mverts(byte_order, first, count):
+    return b"".join(
+        struct.pack(
+            f"{byte_order}3f3hcc", i, i + 0.5, -i, 0, 0, -1, b"\1", b"\0")
+        for i in range(first, first + count))
+
+def _blend_file(byte_order, pointer_size):
+    """
+    Build a small .blend file in the given byte order and pointer size.
+    """
+    block = functools.partial(_block, byte_order, pointer_size)
+    data = b"BLENDER"
+    data += {4: b"_", 8: b"-"}[pointer_size]
+    data += {"<": b"v", ">": b"V"}[byte_order]
+    data += b"293"
+    data += block(
+        b"OB", 0, 2,
+        _id(byte_order, pointer_size, 0xDEADBEEF, b"Cube", 1)
+        + _id(byte_order, pointer_size, 0, b"Cone", 2))
+    data += block(b"MV", 1, 3, _mverts(byte_order, 0, 3))
+    data += block(b"DATA", 1, 2, _mverts(byte_order, 3, 2))
+    data += block(b"DATA", 1, 4, _mverts(byte_order, 5, 4))
+    # Raw data, which also has an SDNA index of 0.
+    data += block(b"DATA", 0, 1, b"\1" * 8)
+    data += block(
+        b"CA", 2, 1,
+        _id(byte_order, pointer_size, 0, b"Camera", 1)
+        + struct.pack(f"{byte_order}d", 2.5))
+    data += block(b"DNA1", 0, 1, _sdna(byte_order, pointer_size))
+    data += block(b"ENDB", 0, 0, b"")
+    # Anything after ENDB isn't a file block.
+    data += b"junk"
+    return data
+
+class BlendfileTest(unittest.TestCase):
+    """
+    Tests against a little-endian file with 8 byte pointers.
+    """
+
+    byte_order = "<"
+    pointer_size = 8
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".blend")
+        with os.fdopen(handle, "wb") as f:
+            f.write(_blend_file(self.byte_order, self.pointer_size))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_load_struct(self):
+        with blendparse.Blendfile(self.path) as blend:
+            objects = list(blend.get_blocks("OB")["OB\0\0"]())
+            self.assertEqual(objects[1]["name[8]"], "Cone")
+            self.assertEqual(objects[1]["us"], 2)
+
+    def test_header(self):
+        with blendparse.Blendfile(self.path) as blend:
+            self.assertEqual(blend.pointer_size, self.pointer_size)
+            endianness = "little" if self.byte_order == "<" else "big"
+            self.assertEqual(blend.endianness, endianness)
+            self.assertEqual(blend.version, "v2.93")
+
+    def test_decode_fields(self):
+        with blendparse.Blendfile(self.path) as blend:
+            objects = list(blend.get_blocks("OB")["OB\0\0"]())
+            mverts = list(blend.get_blocks("MV")["MV\0\0"]())
+            camera, = blend.get_blocks("CA")["CA\0\0"]()
+            # Pointers are unsigned addresses.
+            self.assertEqual(objects[0]["*next"], 0xDEADBEEF)
+            self.assertEqual(mverts[2]["co[3]"], [2.0, 2.5, -2.0])
+            self.assertEqual(mverts[2]["no[3]"], [0, 0, -1])
+            self.assertEqual(mverts[2]["flag"], b"\1")
+            self.assertEqual(camera["id"]["name[8]"], "Camera")
+            self.assertEqual(camera["mass"], 2.5)
+
+    def test_scan_stops_at_endb(self):
+        with blendparse.Blendfile(self.path) as blend:
+            # Loading the SDNA only scans as far as DNA1.
+            blend._sdna
+            self.assertNotIn("ENDB", blend._block_offsets)
+            self.assertEqual(
+                list(blend.get_blocks()),
+                ["CA\0\0", "DATA", "DNA1", "ENDB", "MV\0\0", "OB\0\0"])
+
+    def test_views_after_close(self):
+        with blendparse.Blendfile(self.path) as blend:
+            view = blend.block_memoryview("OB\0\0")
+        # The view keeps the mapping open.
+        self.assertEqual(bytes(view[self.pointer_size:][:4]), b"Cube")
+        view.release()
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_ndarray_after_close(self):
+        with blendparse.Blendfile(self.path) as blend:
+            array = blend.block_ndarray("MV\0\0", "f4")
+        self.assertEqual(array[5:8].tolist(), [1.0, 1.5, -1.0])
+        del array
+
+    def test_load_struct_after_close(self):
+        with blendparse.Blendfile(self.path) as blend:
+            objects = list(blend.get_blocks("OB")["OB\0\0"]())
+            objects[0].load()
+            mverts = list(blend.get_blocks("MV")["MV\0\0"]())
+        self.assertEqual(objects[0]["name[8]"], "Cube")
+        for structure in (objects[1], mverts[0]):
+            with self.assertRaisesRegex(ValueError, "closed file"):
+                structure.load()
+
+    def test_not_a_blend_file(self):
+        for data, message in (
+                (b"", "empty"), (b"BLENDER", "too short"),
+                (b"PNG\0" * 4, "not 'BLENDER'")):
+            with open(self.path, "wb") as f:
+                f.write(data)
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", ResourceWarning)
+                with self.assertRaisesRegex(
+                        blendparse.BlendDecodeError, message):
+                    blendparse.Blendfile(self.path)
+                gc.collect()
+
+    def test_blend_struct_from_dict(self):
+        structure = blendparse.BlendStruct(lambda: {"us": 1, "lay": 2}, "ID")
+        self.assertEqual(structure["lay"], 2)
+        self.assertEqual(dict(structure), {"us": 1, "lay": 2})
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_get_array_gathers_blocks_sharing_a_code(self):
+        with blendparse.Blendfile(self.path) as blend:
+            co = blend.get_array("MVert", "co[3]")
+        self.assertEqual(co.shape, (9, 3))
+        self.assertEqual(co[:, 0].tolist(), list(range(9)))
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_get_array_of_first_structure(self):
+        # ID is SDNA structure 0, which DNA1, ENDB and raw data also claim.
+        with blendparse.Blendfile(self.path) as blend:
+            us = blend.get_array("ID", "us")
+        self.assertEqual(us.tolist(), [1, 2])
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_get_array_errors(self):
+        with blendparse.Blendfile(self.path) as blend:
+            with self.assertRaisesRegex(ValueError, "Missing Mesh structure"):
+                blend.get_array("Mesh", "co[3]")
+        with self.assertRaisesRegex(ValueError, "closed file"):
+            blend.get_array("MVert", "co[3]")
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_get_block_records(self):
+        with blendparse.Blendfile(self.path) as blend:
+            objects = blend.get_block_records("OB\0\0")
+            self.assertEqual(objects["name[8]"].tolist(), [b"Cube", b"Cone"])
+            self.assertEqual(objects["us"].tolist(), [1, 2])
+            del objects
+
+class BigEndianBlendfileTest(BlendfileTest):
+    """
+    Tests against a big-endian file with 4 byte pointers.
+    """
+
+    byte_order = ">"
+    pointer_size = 4
+
+if __name__ == "__main__":
+    unittest.main()